@@ -1,16 +1,42 @@
 #!/usr/bin/env python3
 """
 Script to fetch IP ranges from various sources and maintain whitelist/blacklist files.
-IP ranges are automatically sorted alphabetically and duplicates are removed.
+IP ranges are sorted by IP version, then by address, and duplicates are removed.
 """
 
+import argparse
+import gzip
+import hashlib
 import json
 import os
+import shutil
+import socket
+import subprocess
 import sys
+import time
 import ipaddress
-from typing import List, Set
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import MappingProxyType
+from typing import Callable, List, Optional, Sequence, Set, Tuple
+from http.client import HTTPException, IncompleteRead
 from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+from urllib.error import HTTPError
+
+# orjson is optional; it parses the multi-MB AWS JSON several times faster.
+# Its JSONDecodeError subclasses json.JSONDecodeError, so handlers stay the same.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# ijson is optional; with it the AWS JSON is parsed as it streams in instead
+# of being loaded into one large dict
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 URLS = {
     'google': [
@@ -27,67 +53,277 @@ URLS = {
 }
 
 # File mappings (support both naming conventions)
-WHITELIST_FILES = ['whitelist.txt', 'pass.txt']
-BLACKLIST_FILES = ['blacklist.txt', 'drop.txt']
+WHITELIST_FILES = ('whitelist.txt', 'pass.txt')
+BLACKLIST_FILES = ('blacklist.txt', 'drop.txt')
+
+# Managed lists: name -> (candidate files, header comment); read-only and
+# shared by every step of a run
+LISTS = MappingProxyType({
+    'whitelist': (WHITELIST_FILES, "Whitelist - Google, Cloudflare, GitHub, AWS IP Ranges"),
+    'blacklist': (BLACKLIST_FILES, "Blacklist - AbuseIPDB"),
+})
+
+# Conditional GET validators ({url: {'etag': ..., 'last_modified': ...}}) are
+# kept between runs so unchanged sources answer 304 Not Modified. The file
+# stores them per list, next to a fingerprint of the list file they were
+# merged into: {list: {'fingerprint': ..., 'validators': {url: ...}}}
+VALIDATORS_FILE = '.etags.json'
+validators = {}
+
+# Fetch results are cached on disk so reruns within the TTL skip the network;
+# AbuseIPDB in particular only allows a few blacklist downloads a day
+CACHE_DIR = '.cache'
+CACHE_TTL = 6 * 60 * 60
+
+# Header timestamps use Asia/Jakarta time; WIB has no DST, so a fixed offset
+# avoids a zoneinfo lookup
+WIB = timezone(timedelta(hours=7), 'WIB')
+
+# Buffer size for writing list files
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Lines starting with these are comments in list files
+COMMENT_PREFIXES = ('#', ';')
+
+# JSON paths of the prefix fields in the AWS ip-ranges document
+AWS_PREFIX_PATHS = ('prefixes.item.ip_prefix', 'ipv6_prefixes.item.ipv6_prefix')
+
+# External aggregator used by --collapse when installed; it is much faster
+# than ipaddress on large lists. '-t' drops host bits like strict=False does.
+AGGREGATE_COMMAND = ['aggregate6', '-t']
+
+# Upstream fetches are network-bound, so they run concurrently
+MAX_WORKERS = 8
+
+# Headers sent with every request; large bodies (AWS JSON) are transferred gzipped
+DEFAULT_HEADERS = {'Accept-Encoding': 'gzip'}
+
+# Transient failures are retried with exponential backoff
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@contextmanager
+def open_url(url: str, headers: dict = None):
+    """Open URL as a (gzip-decoded) binary stream, retrying transient errors.
+
+    Yields (stream, validators). The stream is None if the request ultimately
+    fails, with validators also None, or if the resource is unchanged since
+    the last run, with validators empty. validators holds the response's
+    ETag/Last-Modified; callers return them for committing only once the
+    body has been parsed.
+    """
+    req_headers = {**DEFAULT_HEADERS, **(headers or {})}
+    cached = validators.get(url, {})
+    if 'etag' in cached:
+        req_headers['If-None-Match'] = cached['etag']
+    if 'last_modified' in cached:
+        req_headers['If-Modified-Since'] = cached['last_modified']
+    req = Request(url, headers=req_headers)
+
+    response = None
+    not_modified = False
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = urlopen(req, timeout=30)
+            break
+        except HTTPError as e:
+            # The error response is not used, so release its connection
+            e.close()
+            if e.code == 304:
+                print(f"Not modified since last run: {url}")
+                not_modified = True
+                break
+            if e.code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                print(f"Error fetching {url}: {e}")
+                break
+        except (HTTPException, OSError) as e:
+            # URLError is an OSError; urllib leaves dropped connections and
+            # read timeouts on the status line unwrapped
+            if attempt == MAX_RETRIES:
+                print(f"Error fetching {url}: {e}")
+                break
+        time.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+    if response is None:
+        yield None, ({} if not_modified else None)
+        return
+
+    fresh = {}
+    if response.headers.get('ETag'):
+        fresh['etag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        fresh['last_modified'] = response.headers['Last-Modified']
+
+    with response:
+        if response.headers.get('Content-Encoding') == 'gzip':
+            yield gzip.GzipFile(fileobj=response), fresh
+        else:
+            yield response, fresh
+        # Iterating lines stops quietly at a truncated body, unlike read()
+        if response.length:
+            raise IncompleteRead(b'', response.length)
+
+
+def load_validators(file_path: str = VALIDATORS_FILE) -> dict:
+    """Load the per-list conditional GET validators saved by a previous run."""
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading {file_path}: {e}")
+        return {}
 
 
-def fetch_url(url: str, headers: dict = None) -> str:
-    """Fetch content from URL with optional headers."""
+def save_validators(saved: dict, file_path: str = VALIDATORS_FILE):
+    """Save per-list conditional GET validators for the next run."""
+    with open(file_path, 'w') as f:
+        json.dump(saved, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def file_fingerprint(file_path: str) -> Optional[str]:
+    """Return the SHA-256 of a file's contents, or None if it cannot be read."""
     try:
-        req = Request(url)
-        if headers:
-            for key, value in headers.items():
-                req.add_header(key, value)
-
-        with urlopen(req, timeout=30) as response:
-            return response.read().decode('utf-8')
-    except (URLError, HTTPError) as e:
-        print(f"Error fetching {url}: {e}")
+        with open(file_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
         return None
 
 
-def extract_google_ips(urls: List[str]) -> Set[str]:
-    """Extract IP ranges from Google JSON APIs."""
+def cached_fetch(name: str, func: Callable[..., Tuple[Set[str], dict, bool]], *args) -> Tuple[Set[str], dict]:
+    """Run a fetcher, reusing its on-disk result while it is younger than CACHE_TTL.
+
+    The fetcher returns its IPs, the new validators of the URLs it fetched
+    and whether every URL was fetched; the first two are returned.
+    Set HOSTS_NO_CACHE=1 to always fetch.
+    """
+    if os.environ.get('HOSTS_NO_CACHE') == '1':
+        ips, new_validators, _ = func(*args)
+        return ips, new_validators
+
+    cache_path = os.path.join(CACHE_DIR, f"{name}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) < CACHE_TTL:
+            with open(cache_path, 'r') as f:
+                ips = set(json.load(f))
+            print(f"Using cached {name} result ({len(ips)} entries)")
+            return ips, {}
+    except (OSError, ValueError):
+        pass  # Missing or unreadable cache, fetch instead
+
+    ips, new_validators, complete = func(*args)
+
+    # Empty or partial results are not cached, so a failed fetch is retried
+    # next run
+    if ips and complete:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(ips), f)
+        os.replace(tmp_path, cache_path)
+
+    return ips, new_validators
+
+
+def fetch_url(url: str, headers: dict = None) -> Tuple[Optional[bytes], Optional[dict]]:
+    """Fetch raw response body and its validators from URL with optional headers.
+
+    Both are None if the request failed.
+    """
+    with open_url(url, headers) as (stream, fresh):
+        if stream is None:
+            return None, fresh
+        return stream.read(), fresh
+
+
+def fetch_lines(url: str, headers: dict = None) -> Tuple[Set[str], Optional[dict]]:
+    """Fetch non-empty, non-comment lines from URL, reading them as they arrive.
+
+    Returns the lines and the URL's validators, keyed by URL, or None in
+    their place if the request failed.
+    """
+    with open_url(url, headers) as (stream, fresh):
+        if stream is None:
+            return set(), (None if fresh is None else {})
+        lines = set()
+        for line in stream:
+            line = line.decode('utf-8').strip()
+            if line and not line.startswith('#'):
+                lines.add(line)
+    return lines, ({url: fresh} if fresh else {})
+
+
+def is_ip_address(value: str) -> bool:
+    """Check whether value is a single IPv4 or IPv6 address."""
+    # inet_pton is a C call; ipaddress builds a Python object per value
+    try:
+        socket.inet_pton(socket.AF_INET6 if ':' in value else socket.AF_INET, value)
+        return True
+    except OSError:
+        return False
+
+
+def extract_google_ips(urls: List[str]) -> Tuple[Set[str], dict, bool]:
+    """Extract IP ranges from Google JSON APIs, fetching all URLs concurrently."""
     ips = set()
-    for url in urls:
-        print(f"Fetching Google IPs from {url}...")
-        content = fetch_url(url)
-        if content:
-            try:
-                data = json.loads(content)
-                if 'prefixes' in data:
-                    for prefix in data['prefixes']:
-                        if 'ipv4Prefix' in prefix:
-                            ips.add(prefix['ipv4Prefix'])
-                        if 'ipv6Prefix' in prefix:
-                            ips.add(prefix['ipv6Prefix'])
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON from {url}: {e}")
-    return ips
-
-
-def extract_cloudflare_ips() -> Set[str]:
+    new_validators = {}
+    complete = True
+    with ThreadPoolExecutor(max_workers=len(urls) or 1) as executor:
+        for url, (content, fresh) in zip(urls, executor.map(fetch_google_url, urls)):
+            if fresh is None:
+                complete = False
+            if content:
+                try:
+                    data = json_loads(content)
+                    if 'prefixes' in data:
+                        for prefix in data['prefixes']:
+                            if 'ipv4Prefix' in prefix:
+                                ips.add(prefix['ipv4Prefix'])
+                            if 'ipv6Prefix' in prefix:
+                                ips.add(prefix['ipv6Prefix'])
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing JSON from {url}: {e}")
+                    complete = False
+                    continue
+                if fresh:
+                    new_validators[url] = fresh
+    return ips, new_validators, complete
+
+
+def fetch_google_url(url: str) -> Tuple[Optional[bytes], Optional[dict]]:
+    """Fetch one Google IP range document."""
+    print(f"Fetching Google IPs from {url}...")
+    return fetch_url(url)
+
+
+def extract_cloudflare_ips(keys: List[str] = None) -> Tuple[Set[str], dict, bool]:
     """Extract IP ranges from Cloudflare."""
     ips = set()
-    for key in ['cloudflare_v4', 'cloudflare_v6']:
+    new_validators = {}
+    complete = True
+    for key in keys or ['cloudflare_v4', 'cloudflare_v6']:
         print(f"Fetching Cloudflare IPs from {URLS[key]}...")
-        content = fetch_url(URLS[key])
-        if content:
-            for line in content.strip().split('\n'):
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    ips.add(line)
-    return ips
+        lines, fresh = fetch_lines(URLS[key])
+        if fresh is None:
+            complete = False
+            continue
+        ips.update(lines)
+        new_validators.update(fresh)
+    return ips, new_validators, complete
 
 
-def extract_github_ips() -> Set[str]:
+def extract_github_ips() -> Tuple[Set[str], dict, bool]:
     """Extract IP ranges from GitHub API."""
     print(f"Fetching GitHub IPs from {URLS['github']}...")
     ips = set()
-    content = fetch_url(URLS['github'])
+    content, fresh = fetch_url(URLS['github'])
     if content:
         try:
-            data = json.loads(content)
+            data = json_loads(content)
             # GitHub provides various IP ranges
             keys = ['hooks', 'web', 'api', 'git', 'pages', 'importer', 'actions', 'dependabot']
             for key in keys:
@@ -96,17 +332,21 @@ def extract_github_ips() -> Set[str]:
                         ips.update(data[key])
         except json.JSONDecodeError as e:
             print(f"Error parsing GitHub JSON: {e}")
-    return ips
+            return ips, {}, False
+    return ips, ({URLS['github']: fresh} if fresh else {}), fresh is not None
 
 
-def extract_aws_ips() -> Set[str]:
+def extract_aws_ips() -> Tuple[Set[str], dict, bool]:
     """Extract IP ranges from AWS."""
     print(f"Fetching AWS IPs from {URLS['aws']}...")
+    if ijson is not None:
+        return stream_aws_ips()
+
     ips = set()
-    content = fetch_url(URLS['aws'])
+    content, fresh = fetch_url(URLS['aws'])
     if content:
         try:
-            data = json.loads(content)
+            data = json_loads(content)
             if 'prefixes' in data:
                 for prefix in data['prefixes']:
                     if 'ip_prefix' in prefix:
@@ -117,10 +357,28 @@ def extract_aws_ips() -> Set[str]:
                         ips.add(prefix['ipv6_prefix'])
         except json.JSONDecodeError as e:
             print(f"Error parsing AWS JSON: {e}")
-    return ips
+            return ips, {}, False
+    return ips, ({URLS['aws']: fresh} if fresh else {}), fresh is not None
 
 
-def extract_abuseipdb_ips(api_key: str = None) -> Set[str]:
+def stream_aws_ips() -> Tuple[Set[str], dict, bool]:
+    """Extract IP ranges from AWS, parsing the JSON as it is received."""
+    ips = set()
+    try:
+        with open_url(URLS['aws']) as (stream, fresh):
+            if stream is None:
+                return ips, {}, fresh is not None
+            for path, event, value in ijson.parse(stream):
+                if event == 'string' and path in AWS_PREFIX_PATHS:
+                    ips.add(value)
+    except ijson.JSONError as e:
+        # A broken body yields neither entries nor validators
+        print(f"Error parsing AWS JSON: {e}")
+        return set(), {}, False
+    return ips, ({URLS['aws']: fresh} if fresh else {}), True
+
+
+def extract_abuseipdb_ips(api_key: str = None) -> Tuple[Set[str], dict, bool]:
     """Extract IP ranges from AbuseIPDB."""
     print(f"Fetching AbuseIPDB blacklist...")
     ips = set()
@@ -130,93 +388,216 @@ def extract_abuseipdb_ips(api_key: str = None) -> Set[str]:
 
     if not api_key:
         print("Warning: ABUSEIPDB_API_KEY not found. Skipping AbuseIPDB.")
-        return ips
+        return ips, {}, True
 
     headers = {
         'Key': api_key,
         'Accept': 'application/json'
     }
 
-    # Add query parameter for plaintext format
+    # Plaintext format is streamed line by line instead of buffered whole
     url = f"{URLS['abuseipdb']}?plaintext"
-    content = fetch_url(url, headers)
+    lines, new_validators = fetch_lines(url, headers)
+    ips.update(filter(is_ip_address, lines))
 
-    if content:
-        try:
-            # Try JSON format first
-            data = json.loads(content)
-            if 'data' in data:
-                for item in data['data']:
-                    if 'ipAddress' in item:
-                        ips.add(item['ipAddress'])
-        except json.JSONDecodeError:
-            # Fallback to plaintext format
-            for line in content.strip().split('\n'):
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    # Validate if it's a valid IP
-                    try:
-                        ipaddress.ip_address(line)
-                        ips.add(line)
-                    except ValueError:
-                        continue
-
-    return ips
+    return ips, new_validators or {}, new_validators is not None
 
 
 def read_existing_ips(file_path: str) -> Set[str]:
-    """Read existing IPs from file."""
-    ips = set()
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    ips.add(line)
-    return ips
+    """Read existing IPs from file, skipping blank and '#'/';' comment lines."""
+    if not os.path.exists(file_path):
+        return set()
+    with open(file_path, 'r') as f:
+        lines = f.read().splitlines()
+    return {line for line in map(str.strip, lines) if line and not line.startswith(COMMENT_PREFIXES)}
+
+
+def ip_sort_key(ip: str) -> Optional[tuple]:
+    """Return a (version, packed address, prefix length) sort key, or None."""
+    address, _, prefixlen = ip.partition('/')
+    # inet_pton is a C call, far cheaper than building an ipaddress object
+    try:
+        if ':' in address:
+            return (6, socket.inet_pton(socket.AF_INET6, address), int(prefixlen or 128))
+        return (4, socket.inet_pton(socket.AF_INET, address), int(prefixlen or 32))
+    except (OSError, ValueError):
+        return None
+
+
+def is_ip_network(value: str) -> bool:
+    """Check whether value is an IPv4/IPv6 address or CIDR network."""
+    _, slash, prefixlen = value.partition('/')
+    if slash and not (prefixlen.isascii() and prefixlen.isdigit()):
+        return False
+    key = ip_sort_key(value)
+    return key is not None and key[2] <= len(key[1]) * 8
+
+
+def drop_invalid_ips(ips: Set[str], source: str) -> Set[str]:
+    """Remove entries that are not IP addresses or networks, with a warning."""
+    valid = set(filter(is_ip_network, ips))
+    if len(valid) < len(ips):
+        print(f"Warning: dropped {len(ips) - len(valid)} invalid entries from {source}")
+    return valid
 
 
 def sort_ips(ips: Set[str]) -> List[str]:
-    """Sort IPs alphabetically with proper IP sorting."""
-    ipv4_list = []
-    ipv6_list = []
+    """Sort IPs by version and network address, with non-IP entries last."""
+    keyed = []
     other_list = []
 
+    for ip in ips:
+        key = ip_sort_key(ip)
+        if key is None:
+            other_list.append(ip)
+        else:
+            keyed.append((*key, ip))
+
+    keyed.sort()
+    other_list.sort()
+
+    return [item[-1] for item in keyed] + other_list
+
+
+def prune_covered_ips(ips: Set[str]) -> Set[str]:
+    """Drop entries already covered by a broader network in the same set.
+
+    Unlike collapse_ips, the remaining entries are kept exactly as written.
+    """
+    pruned = set()
+    ranges = []
+
+    for ip in ips:
+        key = ip_sort_key(ip)
+        if key is None:
+            pruned.add(ip)
+            continue
+        version, packed, prefixlen = key
+        if not 0 <= prefixlen <= len(packed) * 8:
+            pruned.add(ip)
+            continue
+        host_bits = len(packed) * 8 - prefixlen
+        start = int.from_bytes(packed, 'big') >> host_bits << host_bits
+        ranges.append((version, start, prefixlen, ip, start + (1 << host_bits) - 1))
+
+    # After sorting by start address and prefix length, any network that
+    # begins inside the last kept one is nested within it
+    ranges.sort()
+    last_version, last_end = None, -1
+    for version, start, _, ip, end in ranges:
+        if version == last_version and start <= last_end:
+            continue
+        pruned.add(ip)
+        last_version, last_end = version, end
+
+    return pruned
+
+
+def collapse_ips(ips: Set[str]) -> Set[str]:
+    """Collapse overlapping and adjacent networks into the fewest CIDR blocks.
+
+    Single addresses stay in plain form and non-IP entries are kept as-is.
+    """
+    collapsed = aggregate_with_tool(ips)
+    if collapsed is not None:
+        return collapsed
+
+    networks = {4: [], 6: []}
+    collapsed = set()
+
     for ip in ips:
         try:
             network = ipaddress.ip_network(ip, strict=False)
-            if network.version == 4:
-                ipv4_list.append(ip)
-            else:
-                ipv6_list.append(ip)
         except ValueError:
-            other_list.append(ip)
+            collapsed.add(ip)
+            continue
+        networks[network.version].append(network)
+
+    for version_networks in networks.values():
+        for network in ipaddress.collapse_addresses(version_networks):
+            if network.prefixlen == network.max_prefixlen:
+                collapsed.add(str(network.network_address))
+            else:
+                collapsed.add(str(network))
 
-    # Sort each category
-    ipv4_sorted = sorted(ipv4_list, key=lambda x: ipaddress.ip_network(x, strict=False))
-    ipv6_sorted = sorted(ipv6_list, key=lambda x: ipaddress.ip_network(x, strict=False))
-    other_sorted = sorted(other_list)
+    return collapsed
 
-    return ipv4_sorted + ipv6_sorted + other_sorted
 
+def aggregate_with_tool(ips: Set[str]) -> Set[str]:
+    """Collapse IPs with the external aggregator, or return None if unavailable."""
+    if shutil.which(AGGREGATE_COMMAND[0]) is None:
+        return None
 
-def write_ips_to_file(file_path: str, ips: Set[str], header_comment: str = None):
-    """Write IPs to file in sorted order."""
-    sorted_ips = sort_ips(ips)
+    # Only valid networks are piped through; the tool would silently drop
+    # anything else, so those entries are kept as-is
+    collapsed = set()
+    candidates = []
+    for ip in ips:
+        if is_ip_network(ip):
+            candidates.append(ip)
+        else:
+            collapsed.add(ip)
 
-    with open(file_path, 'w') as f:
-        if header_comment:
-            f.write(f"# {header_comment}\n")
-            f.write(f"# Total entries: {len(sorted_ips)}\n")
-            f.write(f"# Last updated: {os.popen('date').read().strip()}\n\n")
+    try:
+        proc = subprocess.run(
+            AGGREGATE_COMMAND,
+            input="\n".join(candidates).encode(),
+            capture_output=True,
+            check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Error running {AGGREGATE_COMMAND[0]}, using built-in collapse: {e}")
+        return None
 
-        for ip in sorted_ips:
-            f.write(f"{ip}\n")
+    # Warnings mean some input was skipped even though the exit status is 0
+    if proc.stderr:
+        print(f"{AGGREGATE_COMMAND[0]} reported errors, using built-in collapse: "
+              f"{proc.stderr.decode().strip()}")
+        return None
+
+    for network in proc.stdout.decode().split():
+        address, _, prefixlen = network.partition('/')
+        if prefixlen == ('128' if ':' in address else '32'):
+            collapsed.add(address)
+        else:
+            collapsed.add(network)
+
+    return collapsed
+
+
+def get_current_timestamp() -> str:
+    """Return the current time in WIB for file headers."""
+    return datetime.now(WIB).strftime('%Y-%m-%d %H:%M:%S %Z')
 
+
+def write_ips_to_file(file_path: str, ips: Set[str], header_comment: str = None,
+                      timestamp: str = None):
+    """Write IPs to file in sorted order.
+
+    The file is written to a temporary sibling and then renamed over the
+    original, so an interrupted run never leaves a truncated list behind.
+    """
+    sorted_ips = sort_ips(ips)
+    tmp_path = f"{file_path}.tmp"
+
+    header = ""
+    if header_comment:
+        header = (
+            f"# {header_comment}\n"
+            f"# Total entries: {len(sorted_ips)}\n"
+            f"# Last updated: {timestamp or get_current_timestamp()}\n\n"
+        )
+    body = "\n".join(sorted_ips) + "\n" if sorted_ips else ""
+
+    # Header and body go out together through a large buffer
+    with open(tmp_path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        f.writelines([header, body])
+
+    os.replace(tmp_path, file_path)
     print(f"Written {len(sorted_ips)} entries to {file_path}")
 
 
-def get_file_path(file_list: List[str]) -> str:
+def get_file_path(file_list: Sequence[str]) -> str:
     """Get the first existing file path or create the first one."""
     for file_path in file_list:
         if os.path.exists(file_path):
@@ -224,84 +605,152 @@ def get_file_path(file_list: List[str]) -> str:
     return file_list[0]  # Return first option if none exist
 
 
-def main():
+def merge_with_existing(file_list: Sequence[str], new_ips: Set[str], name: str,
+                        collapse: bool = False) -> Tuple[str, Set[str], bool]:
+    """Merge new IPs with the entries already in a list file.
+
+    Returns the file path, the merged set and whether the file needs rewriting.
+    """
+    file_path = get_file_path(file_list)
+    existing = read_existing_ips(file_path)
+    print(f"Existing {name} entries: {len(existing)}")
+
+    # A single union; its size tells how many entries are new
+    merged = existing.union(new_ips)
+    new_count = len(merged) - len(existing)
+    print(f"New {name} entries to add: {new_count}")
+
+    # Nothing new: the list is kept exactly as it is on disk, unless a
+    # collapse was asked for, which must also apply to existing entries
+    if not new_count and not collapse:
+        return file_path, existing, not os.path.exists(file_path)
+
+    if collapse:
+        merged = collapse_ips(merged)
+        print(f"Collapsed {name} entries: {len(merged)}")
+    else:
+        merged_count = len(merged)
+        merged = prune_covered_ips(merged)
+        if len(merged) < merged_count:
+            print(f"Covered {name} entries dropped: {merged_count - len(merged)}")
+
+    # Pruning and collapsing can remove entries, so compare whole sets
+    changed = merged != existing
+    return file_path, merged, changed or not os.path.exists(file_path)
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--collapse',
+        action='store_true',
+        help="merge overlapping and adjacent networks into the fewest CIDR blocks before writing"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
     """Main function to fetch and update IP lists."""
+    args = parse_args(argv)
+
     print("Starting IP ranges fetch and update process...\n")
 
-    # Fetch whitelist IPs
+    # A 304 contributes no entries, which is only safe while a list file still
+    # holds what the run that saved its validators wrote. A deleted, reverted
+    # or trimmed list is refetched in full.
+    saved = load_validators()
+    loaded = {}
+    for name, (files, _) in LISTS.items():
+        record = saved.get(name) or {}
+        fingerprint = file_fingerprint(get_file_path(files))
+        if fingerprint and record.get('fingerprint') == fingerprint:
+            loaded[name] = record.get('validators', {})
+            validators.update(loaded[name])
+        else:
+            loaded[name] = {}
+
+    # Fetch whitelist and blacklist IPs concurrently
     print("=" * 50)
-    print("FETCHING WHITELIST IPs")
+    print("FETCHING IP RANGES")
     print("=" * 50)
 
-    whitelist_ips = set()
-
-    # Google
-    whitelist_ips.update(extract_google_ips(URLS['google']))
-
-    # Cloudflare
-    whitelist_ips.update(extract_cloudflare_ips())
-
-    # GitHub
-    whitelist_ips.update(extract_github_ips())
-
-    # AWS
-    whitelist_ips.update(extract_aws_ips())
-
-    print(f"\nTotal new whitelist IPs fetched: {len(whitelist_ips)}")
+    tasks = [
+        ('whitelist', 'google', extract_google_ips, (URLS['google'],)),
+        ('whitelist', 'cloudflare_v4', extract_cloudflare_ips, (['cloudflare_v4'],)),
+        ('whitelist', 'cloudflare_v6', extract_cloudflare_ips, (['cloudflare_v6'],)),
+        ('whitelist', 'github', extract_github_ips, ()),
+        ('whitelist', 'aws', extract_aws_ips, ()),
+        ('blacklist', 'abuseipdb', extract_abuseipdb_ips, ()),
+    ]
+
+    fetched = {name: [] for name in LISTS}
+    fetched_validators = {name: {} for name in LISTS}
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(tasks))) as executor:
+        futures = {
+            executor.submit(cached_fetch, name, func, *args): (tag, name)
+            for tag, name, func, args in tasks
+        }
+        for future in as_completed(futures):
+            tag, name = futures[future]
+            # A failing source is reported and skipped; the others still count
+            # and its validators are dropped so the next run fetches it again
+            try:
+                ips, fresh = future.result()
+            except Exception as e:
+                print(f"Error fetching {name}: {e!r}")
+                continue
+            fetched[tag].append(drop_invalid_ips(ips, name))
+            fetched_validators[tag].update(fresh)
 
-    # Fetch blacklist IPs
-    print("\n" + "=" * 50)
-    print("FETCHING BLACKLIST IPs")
-    print("=" * 50)
+    # One union per list sizes each hash table once for all sources
+    fetched_ips = {name: set().union(*parts) for name, parts in fetched.items()}
 
-    blacklist_ips = extract_abuseipdb_ips()
-    print(f"\nTotal new blacklist IPs fetched: {len(blacklist_ips)}")
+    print()
+    for name, ips in fetched_ips.items():
+        print(f"Total new {name} IPs fetched: {len(ips)}")
 
     # Merge with existing files
     print("\n" + "=" * 50)
     print("MERGING WITH EXISTING FILES")
     print("=" * 50)
 
-    # Whitelist
-    whitelist_file = get_file_path(WHITELIST_FILES)
-    existing_whitelist = read_existing_ips(whitelist_file)
-    print(f"Existing whitelist entries: {len(existing_whitelist)}")
-
-    merged_whitelist = existing_whitelist.union(whitelist_ips)
-    new_whitelist_count = len(merged_whitelist) - len(existing_whitelist)
-    print(f"New whitelist entries to add: {new_whitelist_count}")
-
-    # Blacklist
-    blacklist_file = get_file_path(BLACKLIST_FILES)
-    existing_blacklist = read_existing_ips(blacklist_file)
-    print(f"Existing blacklist entries: {len(existing_blacklist)}")
-
-    merged_blacklist = existing_blacklist.union(blacklist_ips)
-    new_blacklist_count = len(merged_blacklist) - len(existing_blacklist)
-    print(f"New blacklist entries to add: {new_blacklist_count}")
+    merged_lists = {
+        name: merge_with_existing(files, fetched_ips[name], name, args.collapse)
+        for name, (files, _) in LISTS.items()
+    }
 
     # Write to files
     print("\n" + "=" * 50)
     print("WRITING TO FILES")
     print("=" * 50)
 
-    write_ips_to_file(
-        whitelist_file,
-        merged_whitelist,
-        "Whitelist - Google, Cloudflare, GitHub, AWS IP Ranges"
-    )
-
-    write_ips_to_file(
-        blacklist_file,
-        merged_blacklist,
-        "Blacklist - AbuseIPDB"
-    )
+    # All files share one timestamp for the run
+    timestamp = get_current_timestamp()
+
+    # Unchanged files are left alone so no-op runs produce no git diff
+    for name, (file_path, merged, changed) in merged_lists.items():
+        if changed:
+            write_ips_to_file(file_path, merged, LISTS[name][1], timestamp)
+        else:
+            print(f"No changes to {file_path}, skipping write")
+
+    # Validators are only committed once their data has been merged, tied to
+    # the list file as it now stands
+    save_validators({
+        name: {
+            'fingerprint': file_fingerprint(file_path),
+            'validators': {**loaded[name], **fetched_validators[name]},
+        }
+        for name, (file_path, _, _) in merged_lists.items()
+    })
 
     print("\n" + "=" * 50)
     print("PROCESS COMPLETED SUCCESSFULLY")
     print("=" * 50)
-    print(f"Total whitelist entries: {len(merged_whitelist)}")
-    print(f"Total blacklist entries: {len(merged_blacklist)}")
+    for name, (_, merged, _) in merged_lists.items():
+        print(f"Total {name} entries: {len(merged)}")
 
     return 0
 